@@ -1,20 +1,30 @@
-import os, time, re, io, json
-from typing import Dict, Any
+import os, time, re, io, asyncio, hashlib
+from typing import Dict, Any, Tuple
+from urllib.parse import urlsplit
 from fastapi import FastAPI, Request, HTTPException, Query, Response
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
+import orjson
+from cachetools import TTLCache
 from yt_dlp import YoutubeDL
-from collections import defaultdict
 
 APP_DOMAIN = os.getenv("APP_DOMAIN", "https://d.end.yt")
 TURNSTILE_SECRET = os.getenv("TURNSTILE_SECRET", "")  # defina no Coolify
 RATE_WINDOW_SEC = 1800  # 30min
 RATE_MAX_ANALYZE = 10
 RATE_MAX_DL = 5
+RATE_REFILL_ANALYZE = RATE_MAX_ANALYZE / RATE_WINDOW_SEC
+RATE_REFILL_DL = RATE_MAX_DL / RATE_WINDOW_SEC
+CACHE_TTL_SEC = 600  # 10 min
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))  # acima disso, sai o menos usado
+_APP_PREFIX = APP_DOMAIN.lower()
+_MAX_REFERER = 2048
+_MAX_URL = 2048
+_FMTID_RE = re.compile(r"[A-Za-z0-9_+\-.]{1,32}")
 COOKIE_PATH = os.path.join(os.path.dirname(__file__), "..", "cookies.txt")
 
-app = FastAPI(title="d.end.yt downloader")
+app = FastAPI(title="d.end.yt downloader", default_response_class=ORJSONResponse)
 
 # CORS estrito: só o seu domínio
 app.add_middleware(
@@ -31,62 +41,141 @@ YTDLP_OPTS_PROBE = {
     "skip_download": True,
     "noplaylist": True,
     "extract_flat": False,
+    # sem manifests DASH/HLS: menos requests no extract_info, e os formatos
+    # m3u8 nem podem ser servidos pelo stream direto do /download
+    "extractor_args": {"youtube": {"skip": ["dash", "hls"]}},
+    "cookiefile": COOKIE_PATH,
+}
+YTDLP_OPTS_DL = {
+    "quiet": True,
+    "no_warnings": True,
+    "extractor_args": {"youtube": {"skip": ["dash", "hls"]}},
     "cookiefile": COOKIE_PATH,
 }
 
-rate_hits_analyze: Dict[str, list] = defaultdict(list)
-rate_hits_download: Dict[str, list] = defaultdict(list)
-meta_cache: Dict[str, Dict[str, Any]] = {}
-meta_cache_ttl: Dict[str, float] = {}
-
-VIDEO_URL_ALLOWED = re.compile(
-    r"^(https?://)?(www\.)?(youtube\.com|youtu\.be|music\.youtube\.com)/"
-)
+# limita quantos extract_info do yt_dlp rodam ao mesmo tempo (em threads)
+YTDLP_MAX_CONCURRENCY = 8
+_ydl_sem = asyncio.Semaphore(YTDLP_MAX_CONCURRENCY)
+
+DL_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+# clientes HTTP compartilhados (reaproveitam conexões/TLS entre requests)
+@app.on_event("startup")
+async def open_http_clients():
+    app.state.turnstile_client = httpx.AsyncClient(timeout=10, http2=True)
+    app.state.dl_client = httpx.AsyncClient(
+        timeout=None,
+        follow_redirects=True,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await app.state.turnstile_client.aclose()
+    await app.state.dl_client.aclose()
+
+# token bucket por IP: (tokens restantes, último refill)
+rate_hits_analyze: Dict[str, Tuple[float, float]] = {}
+rate_hits_download: Dict[str, Tuple[float, float]] = {}
+_monotonic = time.monotonic
+# guarda o JSON já serializado: cache hit não reencoda nada
+meta_cache: TTLCache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SEC)
+_cache_get = meta_cache.__getitem__
+# format_id -> {url, ext} por vídeo, para o /download não repetir o extract_info
+fmt_cache: TTLCache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SEC)
+# extrações em andamento por URL: requests simultâneos esperam a mesma
+_inflight: Dict[str, asyncio.Future] = {}
+
+ALLOWED_HOSTS = frozenset({
+    "youtube.com",
+    "www.youtube.com",
+    "youtu.be",
+    "music.youtube.com",
+    "m.youtube.com",
+})
+_allowed = ALLOWED_HOSTS.__contains__
 
 def client_ip(req: Request) -> str:
-    xff = req.headers.get("x-forwarded-for", "").split(",")[0].strip()
-    return xff or req.client.host
-
-def rate_ok(bucket: Dict[str, list], ip: str, limit: int) -> bool:
-    now = time.time()
-    bucket[ip] = [t for t in bucket[ip] if now - t < RATE_WINDOW_SEC]
-    if len(bucket[ip]) >= limit:
+    xff = req.headers.get("x-forwarded-for")
+    if xff:
+        head = xff.partition(",")[0].strip()
+        if head:
+            return head
+    return req.client.host
+
+def rate_ok(bucket: Dict[str, Tuple[float, float]], ip: str, capacity: int, refill_per_sec: float) -> bool:
+    now = _monotonic()
+    tokens, last = bucket.get(ip, (capacity, now))
+    tokens = min(capacity, tokens + (now - last) * refill_per_sec)
+    if tokens < 1:
+        bucket[ip] = (tokens, now)
         return False
-    bucket[ip].append(now)
+    bucket[ip] = (tokens - 1, now)
     return True
 
+RATE_SWEEP_INTERVAL_SEC = 300
+
+async def sweep_rate_buckets():
+    # após RATE_WINDOW_SEC sem uso o bucket já estaria cheio: pode sair do dict
+    while True:
+        await asyncio.sleep(RATE_SWEEP_INTERVAL_SEC)
+        now = _monotonic()
+        for bucket in (rate_hits_analyze, rate_hits_download):
+            dead = [ip for ip, (_, last) in bucket.items() if now - last > RATE_WINDOW_SEC]
+            for ip in dead:
+                bucket.pop(ip, None)
+
+@app.on_event("startup")
+async def start_rate_sweep():
+    app.state.rate_sweep_task = asyncio.create_task(sweep_rate_buckets())
+
+@app.on_event("shutdown")
+async def stop_rate_sweep():
+    app.state.rate_sweep_task.cancel()
+
 async def verify_turnstile(token: str, ip: str) -> bool:
     if not TURNSTILE_SECRET:
         return True  # fallback em dev
     url = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.post(url, data={"secret": TURNSTILE_SECRET, "response": token, "remoteip": ip})
+    r = await app.state.turnstile_client.post(url, data={"secret": TURNSTILE_SECRET, "response": token, "remoteip": ip})
     data = r.json()
     return bool(data.get("success"))
 
 def validate_url(url: str):
-    if not VIDEO_URL_ALLOWED.search(url or ""):
+    url = url or ""
+    if not url.lower().startswith(("http://", "https://")):
+        url = "https://" + url  # aceita URL sem esquema, como antes
+    try:
+        p = urlsplit(url)
+        host = p.hostname
+    except ValueError:
+        host = None
+    if host is None or p.scheme not in ("http", "https") or not _allowed(host):
         raise HTTPException(status_code=400, detail="URL inválida ou domínio não permitido.")
 
-def extract_meta(url: str) -> Dict[str, Any]:
-    with YoutubeDL(YTDLP_OPTS_PROBE) as ydl:
-        info = ydl.extract_info(url, download=False)
-    formats = []
-    for f in (info.get("formats") or []):
-        if not f.get("url"):
-            continue
-        formats.append({
-            "format_id": f.get("format_id"),
-            "ext": f.get("ext"),
-            "vcodec": f.get("vcodec"),
-            "acodec": f.get("acodec"),
-            "height": f.get("height"),
-            "filesize": f.get("filesize") or f.get("filesize_approx"),
-            "fps": f.get("fps"),
-            "tbr": f.get("tbr"),
-            "format_note": f.get("format_note"),
-        })
-    return {
+def extract_info(url: str, opts: Dict[str, Any]) -> Dict[str, Any]:
+    with YoutubeDL(opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+async def run_ydl(func, *args):
+    # extract_info é bloqueante; roda fora do event loop
+    async with _ydl_sem:
+        return await asyncio.to_thread(func, *args)
+
+# campos de cada formato expostos pelo /analyze (sem a URL de origem)
+_FMT_KEYS = ("format_id", "ext", "vcodec", "acodec", "height", "fps", "tbr", "format_note")
+
+def extract_meta(url: str) -> Tuple[bytes, Dict[str, Any]]:
+    # devolve o JSON do /analyze já serializado + o índice de formatos do /download
+    info = extract_info(url, YTDLP_OPTS_PROBE)
+    playable = [f for f in (info.get("formats") or ()) if f.get("url")]
+    formats = [
+        {k: f.get(k) for k in _FMT_KEYS} | {"filesize": f.get("filesize") or f.get("filesize_approx")}
+        for f in playable
+    ]
+    fmt_index = {f["format_id"]: {"url": f["url"], "ext": f.get("ext")} for f in playable}
+    data = {
         "id": info.get("id"),
         "title": info.get("title"),
         "thumbnail": info.get("thumbnail"),
@@ -94,6 +183,7 @@ def extract_meta(url: str) -> Dict[str, Any]:
         "uploader": info.get("uploader"),
         "formats": formats
     }
+    return orjson.dumps(data), {"id": data["id"], "formats": fmt_index}
 
 @app.post("/analyze")
 async def analyze(req: Request):
@@ -109,74 +199,100 @@ async def analyze(req: Request):
     if "curl" in ua.lower():
         raise HTTPException(status_code=403, detail="Agente não autorizado.")
 
-    if not rate_ok(rate_hits_analyze, ip, RATE_MAX_ANALYZE):
+    if not rate_ok(rate_hits_analyze, ip, RATE_MAX_ANALYZE, RATE_REFILL_ANALYZE):
         raise HTTPException(status_code=429, detail="Muitas análises. Tente mais tarde.")
 
+    validate_url(url)
+
+    # checagens locais primeiro: request rejeitado não chega a chamar o Cloudflare
     if not await verify_turnstile(captcha, ip):
         raise HTTPException(status_code=403, detail="Falha na verificação humana.")
 
-    validate_url(url)
-
-    cache_key = url
-    if cache_key in meta_cache and time.time() < meta_cache_ttl.get(cache_key, 0):
-        return JSONResponse(meta_cache[cache_key])
+    try:
+        return Response(content=_cache_get(url), media_type="application/json")
+    except KeyError:
+        pass
+
+    fut = _inflight.get(url)
+    if fut is None:
+        fut = asyncio.get_running_loop().create_future()
+        _inflight[url] = fut
+        try:
+            payload, fmt_entry = await run_ydl(extract_meta, url)
+            fmt_cache[url] = fmt_entry
+            meta_cache[url] = payload
+            fut.set_result(payload)
+        except Exception as e:
+            fut.set_exception(e)
+        finally:
+            _inflight.pop(url, None)
+            if not fut.done():
+                fut.cancel()
 
     try:
-        data = extract_meta(url)
+        # shield: cancelar um request que está esperando não cancela o futuro compartilhado
+        payload = await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        if not fut.cancelled():
+            raise  # o próprio request foi cancelado
+        # o request que fazia a extração caiu antes de terminar
+        raise HTTPException(status_code=503, detail="Análise interrompida. Tente novamente.")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Falha ao extrair metadados: {e}")
 
-    meta_cache[cache_key] = data
-    meta_cache_ttl[cache_key] = time.time() + 600  # 10 min
-
-    return JSONResponse(data)
+    return Response(content=payload, media_type="application/json")
 
 @app.get("/download")
 async def download(req: Request,
                    url: str = Query(...),
                    format_id: str = Query(...),
                    csrf: str = Query(None)):
+    if not format_id:
+        raise HTTPException(status_code=400, detail="Formato ausente.")
+    if not _FMTID_RE.fullmatch(format_id):
+        raise HTTPException(status_code=400, detail="format_id inválido.")
+    if len(url) > _MAX_URL:
+        raise HTTPException(status_code=400, detail="URL inválida ou domínio não permitido.")
+
     ip = client_ip(req)
     referer = req.headers.get("referer", "")
-    if not referer.startswith(APP_DOMAIN):
+    if len(referer) > _MAX_REFERER or not referer.lower().startswith(_APP_PREFIX):
         raise HTTPException(status_code=403, detail="Referer inválido.")
 
-    if not rate_ok(rate_hits_download, ip, RATE_MAX_DL):
+    if not rate_ok(rate_hits_download, ip, RATE_MAX_DL, RATE_REFILL_DL):
         raise HTTPException(status_code=429, detail="Muitos downloads. Tente mais tarde.")
 
     validate_url(url)
-    if not format_id:
-        raise HTTPException(status_code=400, detail="Formato ausente.")
 
     try:
-        with YoutubeDL({"quiet": True, "no_warnings": True, "cookiefile": COOKIE_PATH}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            fmts = {f["format_id"]: f for f in info.get("formats", []) if f.get("url")}
-            chosen = fmts.get(format_id)
-            if not chosen:
-                raise HTTPException(status_code=404, detail="Formato não encontrado.")
-            src_url = chosen["url"]
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Falha ao preparar download: {e}")
+        info = fmt_cache[url]
+        chosen = info["formats"].get(format_id)
+    except KeyError:
+        try:
+            info = await run_ydl(extract_info, url, YTDLP_OPTS_DL)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Falha ao preparar download: {e}")
+        chosen = next((f for f in info.get("formats") or ()
+                       if f.get("url") and f.get("format_id") == format_id), None)
+    if not chosen:
+        raise HTTPException(status_code=404, detail="Formato não encontrado.")
+    src_url = chosen["url"]
 
     async def iter_stream():
-        chunk = 64 * 1024
-        async with httpx.AsyncClient(timeout=None, follow_redirects=True) as client:
-            async with client.stream("GET", src_url, headers={"User-Agent": "Mozilla/5.0"}) as r:
-                r.raise_for_status()
-                async for b in r.aiter_bytes(chunk_size=chunk):
-                    yield b
+        # identity: o corpo bruto já é o arquivo final, sem decodificação
+        headers = {"User-Agent": "Mozilla/5.0", "Accept-Encoding": "identity"}
+        async with app.state.dl_client.stream("GET", src_url, headers=headers) as r:
+            r.raise_for_status()
+            async for b in r.aiter_raw(chunk_size=DL_CHUNK_SIZE):
+                yield b
 
     filename = f"canal-yt-{info.get('id','video')}-{format_id}.{chosen.get('ext','mp4')}"
     headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
     return StreamingResponse(iter_stream(), headers=headers, media_type="application/octet-stream")
 
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    return """
+# página servida em "/": encodada uma única vez no import
+_ROOT_HTML = """
     <!DOCTYPE html>
     <html lang="pt-BR">
     <head>
@@ -330,6 +446,15 @@ async def root():
         </script>
     </body>
     </html>
-    """
-
+    """.encode("utf-8")
+_ROOT_ETAG = f'"{hashlib.md5(_ROOT_HTML).hexdigest()}"'
 
+@app.get("/", response_class=HTMLResponse)
+async def root(req: Request):
+    if req.headers.get("if-none-match") == _ROOT_ETAG:
+        return Response(status_code=304, headers={"ETag": _ROOT_ETAG})
+    return Response(
+        content=_ROOT_HTML,
+        media_type="text/html",
+        headers={"ETag": _ROOT_ETAG, "Cache-Control": "public, max-age=3600"},
+    )